@@ -3,28 +3,38 @@ Bulk Email Sender with Gmail API
 Rotates between multiple Gmail accounts to stay under limits and avoid spam.
 """
 
-import os
-import csv
 import time
 import random
 import pickle
-import base64
+import binascii
+import threading
 from pathlib import Path
-from email.mime.text import MIMEText
-from email.mime.multipart import MIMEMultipart
-from email.mime.base import MIMEBase
-from email import encoders
-from datetime import datetime, timedelta
+from collections import Counter
+from datetime import datetime, timedelta, timezone
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
 from google.auth.transport.requests import Request
 from google_auth_oauthlib.flow import InstalledAppFlow
 from googleapiclient.discovery import build
+from googleapiclient.errors import HttpError
+
+from sender_common import (
+    BaseAccountManager, SendLog, build_mime_message, build_personalized_message,
+    load_pending_emails, prefetch_attachments,
+)
 
 
 # Gmail API scope for sending emails
 SCOPES = ['https://www.googleapis.com/auth/gmail.send']
 
+# Messages per batch HTTP request (Gmail allows 100, larger batches trigger rate limiting)
+BATCH_SIZE = 50
+
+# Maps standard base64 to the URL-safe alphabet the Gmail API expects
+_URLSAFE_TABLE = bytes.maketrans(b'+/', b'-_')
 
-class GmailAccountManager:
+
+class GmailAccountManager(BaseAccountManager):
     """Manages multiple Gmail accounts and their sending quotas."""
     
     def __init__(self, credentials_folder="credentials", daily_limit=450):
@@ -34,32 +44,15 @@ class GmailAccountManager:
             daily_limit: Conservative daily limit per account (Gmail allows 500, we use 450 for safety)
         """
         self.credentials_folder = Path(credentials_folder)
-        self.daily_limit = daily_limit
-        self.accounts = {}
-        self.send_counts = {}
+        self.sender_emails = {}     # name -> sender address, fetched once at setup
+        self.creds = {}             # name -> OAuth credentials, kept fresh in the background
         self.last_reset = datetime.now().date()
-        self.load_progress()
-    
-    def load_progress(self):
-        """Load sending progress from file."""
-        progress_file = self.credentials_folder / "send_progress.pickle"
-        if progress_file.exists():
-            with open(progress_file, 'rb') as f:
-                data = pickle.load(f)
-                # Reset counts if it's a new day
-                if data.get('date') == datetime.now().date():
-                    self.send_counts = data.get('counts', {})
-                else:
-                    self.send_counts = {}
-    
-    def save_progress(self):
-        """Save sending progress to file."""
-        progress_file = self.credentials_folder / "send_progress.pickle"
-        with open(progress_file, 'wb') as f:
-            pickle.dump({
-                'date': datetime.now().date(),
-                'counts': self.send_counts
-            }, f)
+        super().__init__(self.credentials_folder / "send_progress.pickle", daily_limit)
+        
+        # Refresh tokens ahead of expiry so sends never stall on an OAuth round-trip
+        self._stop = threading.Event()
+        self._refresher = threading.Thread(target=self._refresh_loop, daemon=True)
+        self._refresher.start()
     
     def setup_account(self, account_name, credentials_file):
         """
@@ -83,84 +76,170 @@ class GmailAccountManager:
                 creds = flow.run_local_server(port=0)
             
             # Save credentials for next time
-            with open(token_file, 'wb') as token:
-                pickle.dump(creds, token)
+            self._save_token(account_name, creds)
         
-        service = build('gmail', 'v1', credentials=creds)
+        self.creds[account_name] = creds
+        
+        # Use the discovery document bundled with google-api-python-client
+        # instead of fetching it from Google for every account
+        service = build('gmail', 'v1', credentials=creds, static_discovery=True, cache_discovery=False)
         self.accounts[account_name] = service
         
+        # Look up the sender address once here instead of once per email
+        try:
+            profile = service.users().getProfile(userId='me').execute()
+            self.sender_emails[account_name] = profile['emailAddress']
+        except Exception:
+            self.sender_emails[account_name] = account_name
+        
         if account_name not in self.send_counts:
             self.send_counts[account_name] = 0
         
         print(f"✓ Account '{account_name}' ready ({self.send_counts[account_name]}/{self.daily_limit} sent today)")
         return service
     
-    def get_available_account(self):
-        """Get an account that hasn't reached its daily limit."""
-        available = [
-            name for name, count in self.send_counts.items()
-            if count < self.daily_limit
-        ]
-        
-        if not available:
-            return None, None
-        
-        # Choose account with lowest send count (balance the load)
-        account_name = min(available, key=lambda x: self.send_counts[x])
-        return account_name, self.accounts[account_name]
+    def _save_token(self, account_name, creds):
+        """Save an account's credentials for next time."""
+        token_file = self.credentials_folder / f"{account_name}_token.pickle"
+        with open(token_file, 'wb') as token:
+            pickle.dump(creds, token)
     
-    def record_send(self, account_name):
-        """Record that an email was sent from an account."""
-        self.send_counts[account_name] = self.send_counts.get(account_name, 0) + 1
+    def _refresh_loop(self, interval=300, margin=600):
+        """Every `interval` seconds, refresh tokens expiring within `margin` seconds."""
+        while not self._stop.wait(interval):
+            for account_name, creds in list(self.creds.items()):
+                if not creds.expiry or not creds.refresh_token:
+                    continue
+                # google-auth keeps expiry as naive UTC
+                if (creds.expiry - datetime.now(timezone.utc).replace(tzinfo=None)).total_seconds() >= margin:
+                    continue
+                try:
+                    creds.refresh(Request())
+                    self._save_token(account_name, creds)
+                except Exception as e:
+                    print(f"\n⚠ Token refresh failed for {account_name}: {e}")
+    
+    def close(self):
+        """Stop the background token refresh and save progress."""
+        self._stop.set()
+        self._refresher.join()
         self.save_progress()
     
-    def get_total_capacity(self):
-        """Get total remaining capacity across all accounts."""
-        return sum(
-            self.daily_limit - count 
-            for count in self.send_counts.values()
-        )
+    def get_available_accounts(self):
+        """Get all set-up accounts under their daily limit, least used first."""
+        self._refresh_counts()
+        available = [
+            name for name in self.accounts
+            if self.send_counts.get(name, 0) < self.daily_limit
+        ]
+        available.sort(key=lambda x: self.send_counts.get(x, 0))
+        return [(name, self.accounts[name], self.sender_emails[name]) for name in available]
+
+
+def _urlsafe_b64_stream(data, chunk_size=57 * 1024):
+    """
+    URL-safe base64-encode bytes into one preallocated buffer, a chunk at a
+    time, instead of materializing a full-size encoded copy plus a
+    translated copy. chunk_size must be a multiple of 3 so only the last
+    chunk carries padding.
+    """
+    view = memoryview(data)
+    out = bytearray(4 * ((len(view) + 2) // 3))
+    pos = 0
+    for start in range(0, len(view), chunk_size):
+        encoded = binascii.b2a_base64(view[start:start + chunk_size], newline=False)
+        out[pos:pos + len(encoded)] = encoded.translate(_URLSAFE_TABLE)
+        pos += len(encoded)
+    return out.decode('ascii')
 
 
 def create_email_with_attachment(sender, to, subject, body, attachment_path):
     """Create an email message with attachment."""
-    message = MIMEMultipart()
-    message['to'] = to
-    message['from'] = sender
-    message['subject'] = subject
-    
-    # Add body
-    message.attach(MIMEText(body, 'plain'))
-    
-    # Add attachment
-    attachment_path = Path(attachment_path)
-    if attachment_path.exists():
-        with open(attachment_path, 'rb') as f:
-            part = MIMEBase('application', 'octet-stream')
-            part.set_payload(f.read())
-        
-        encoders.encode_base64(part)
-        part.add_header(
-            'Content-Disposition',
-            f'attachment; filename="{attachment_path.name}"'
-        )
-        message.attach(part)
-    else:
-        raise FileNotFoundError(f"Attachment not found: {attachment_path}")
+    message = build_mime_message(sender, to, subject, body, attachment_path)
     
     # Encode message
-    raw = base64.urlsafe_b64encode(message.as_bytes()).decode()
+    raw = _urlsafe_b64_stream(message.as_bytes())
     return {'raw': raw}
 
 
-def send_email(service, sender, to, subject, body, attachment_path):
-    """Send an email using Gmail API."""
-    try:
-        message = create_email_with_attachment(sender, to, subject, body, attachment_path)
-        sent = service.users().messages().send(userId='me', body=message).execute()
-        return True, sent['id']
-    except Exception as e:
-        return False, str(e)
+def create_personalized_email(sender, to, name, subject_template, body_template, attachment_path,
+                              shared=False):
+    """
+    Create a personalized email with attachment, filling {name} in the subject
+    and body (see build_personalized_message).
+    """
+    raw = build_personalized_message(
+        sender, to, name, subject_template, body_template, attachment_path, shared
+    )
+    return {'raw': _urlsafe_b64_stream(raw)}
+
+
+def _is_rate_limited(error):
+    """Check whether an API error is a rate limit that is worth retrying."""
+    if not isinstance(error, HttpError):
+        return False
+    if error.resp.status == 429:
+        return True
+    return error.resp.status == 403 and b'ratelimitexceeded' in (error.content or b'').lower()
+
+
+def send_email_batch(service, messages, max_retries=5):
+    """
+    Send several emails in one batch HTTP request using Gmail API.
+    Only the rate-limited entries are retried, with exponential backoff.
+    
+    Args:
+        service: Gmail API service
+        messages: Dict of request_id -> message from create_email_with_attachment
+        max_retries: How many times to retry rate-limited entries
+    
+    Returns:
+        (results, throttled): dict of request_id -> (success, message_id_or_error),
+        and whether Gmail rate limited or errored server-side on any entry
+    """
+    results = {}
+    pending = dict(messages)
+    throttled = False
+    
+    for attempt in range(max_retries + 1):
+        retry = {}
+        
+        def callback(request_id, response, exception):
+            nonlocal throttled
+            if exception is None:
+                results[request_id] = (True, response['id'])
+                return
+            if _is_rate_limited(exception) or (isinstance(exception, HttpError) and exception.resp.status >= 500):
+                throttled = True
+            if _is_rate_limited(exception) and attempt < max_retries:
+                retry[request_id] = pending[request_id]
+            else:
+                results[request_id] = (False, str(exception))
+        
+        batch = service.new_batch_http_request(callback=callback)
+        for request_id, message in pending.items():
+            batch.add(
+                service.users().messages().send(userId='me', body=message),
+                request_id=request_id
+            )
+        
+        try:
+            batch.execute()
+        except Exception as e:
+            # The whole batch request failed; nothing in it was sent
+            for request_id in pending:
+                results.setdefault(request_id, (False, str(e)))
+            break
+        
+        if not retry:
+            break
+        
+        backoff = 2 ** attempt + random.uniform(0, 1)
+        print(f"\n⏳ {len(retry)} rate limited, retrying in {backoff:.0f}s...")
+        time.sleep(backoff)
+        pending = retry
+    
+    return results, throttled
 
 
 def bulk_send_emails(
@@ -170,8 +249,8 @@ def bulk_send_emails(
     body_template,
     min_delay=15,
     max_delay=45,
-    emails_per_session=150,
-    log_file="send_log.csv"
+    log_file="send_log.csv",
+    batch_size=BATCH_SIZE
 ):
     """
     Send bulk emails with anti-spam measures.
@@ -181,108 +260,172 @@ def bulk_send_emails(
         email_list_csv: CSV file with columns: email, name, pdf_path
         subject: Email subject (can use {name} placeholder)
         body_template: Email body (can use {name} placeholder)
-        min_delay: Minimum seconds between emails
-        max_delay: Maximum seconds between emails
-        emails_per_session: Max emails before taking a longer break
+        min_delay: Starting (and lowest) seconds between batches per account
+        max_delay: Seconds between batches an account resumes at after a pause;
+            delays back off up to 5x this when Gmail rate limits
         log_file: File to log sent/failed emails
+        batch_size: Max emails sent per batch HTTP request
     """
-    # Load email list
-    with open(email_list_csv, 'r', encoding='utf-8') as f:
-        reader = csv.DictReader(f)
-        pending_emails = list(reader)
-    
     # Load already sent emails
-    sent_emails = set()
-    log_path = Path(log_file)
-    if log_path.exists():
-        with open(log_path, 'r', encoding='utf-8') as f:
-            reader = csv.DictReader(f)
-            for row in reader:
-                if row.get('status') == 'sent':
-                    sent_emails.add(row['email'])
-    
-    # Filter out already sent
-    pending_emails = [e for e in pending_emails if e['email'] not in sent_emails]
+    send_log = SendLog(log_file, ['timestamp', 'email', 'name', 'account_used', 'status', 'message_id_or_error'])
+    
+    # Load email list, minus already sent
+    pending_emails = load_pending_emails(email_list_csv, send_log.sent_emails)
+    
+    # Only attachments several recipients share are worth encoding once and
+    # caching; each one-off PDF is built directly
+    attachment_uses = Counter(e.pdf_path for e in pending_emails)
     
     print(f"\n{'='*60}")
     print(f"Bulk Email Sender")
     print(f"{'='*60}")
     print(f"Total pending: {len(pending_emails)}")
-    print(f"Already sent: {len(sent_emails)}")
+    print(f"Already sent: {len(send_log.sent_emails)}")
     print(f"Daily capacity remaining: {account_manager.get_total_capacity()}")
     print(f"{'='*60}\n")
     
-    # Open log file for appending
-    log_exists = log_path.exists()
-    log_file_handle = open(log_path, 'a', newline='', encoding='utf-8')
-    log_writer = csv.writer(log_file_handle)
-    if not log_exists:
-        log_writer.writerow(['timestamp', 'email', 'name', 'account_used', 'status', 'message_id_or_error'])
-    
-    session_count = 0
     total_sent = 0
     total_failed = 0
+    position = 0
+    submitted = 0
     
-    for email_data in pending_emails:
-        # Get available account
-        account_name, service = account_manager.get_available_account()
-        
-        if not service:
-            print("\n⚠ All accounts have reached daily limit. Try again tomorrow.")
-            break
-        
-        recipient_email = email_data['email']
-        recipient_name = email_data.get('name', '')
-        attachment_path = email_data['pdf_path']
-        
-        # Personalize subject and body
-        personalized_subject = subject.replace('{name}', recipient_name)
-        personalized_body = body_template.replace('{name}', recipient_name)
-        
-        # Get sender email
-        try:
-            profile = service.users().getProfile(userId='me').execute()
-            sender_email = profile['emailAddress']
-        except:
-            sender_email = account_name
-        
-        # Send email
-        print(f"[{total_sent + total_failed + 1}/{len(pending_emails)}] "
-              f"Sending to {recipient_email} via {account_name}...", end=" ")
-        
-        success, result = send_email(
-            service, sender_email, recipient_email,
-            personalized_subject, personalized_body, attachment_path
-        )
+    account_manager.reset_pacing(min_delay, max_delay)
+    next_send_at = {}   # name -> earliest time the account may start its next batch
+    paused = set()      # accounts resting after heavy throttling
+    in_flight = {}      # name -> (batch_emails, results, future) for the batch it is sending
+    interrupted = False
+    
+    def finish(account_name):
+        """Log an account's finished batch and schedule its next one."""
+        nonlocal total_sent, total_failed
+        batch_emails, results, future = in_flight.pop(account_name)
+        throttled = False
+        if future is not None:
+            batch_results, throttled = future.result()
+            results.update(batch_results)
         
         timestamp = datetime.now().isoformat()
+        batch_sent = 0
         
-        if success:
-            print(f"✓")
-            account_manager.record_send(account_name)
-            log_writer.writerow([timestamp, recipient_email, recipient_name, account_name, 'sent', result])
-            total_sent += 1
-        else:
-            print(f"✗ {result}")
-            log_writer.writerow([timestamp, recipient_email, recipient_name, account_name, 'failed', result])
-            total_failed += 1
+        for i, email_data in enumerate(batch_emails):
+            recipient_email = email_data.email
+            recipient_name = email_data.name
+            success, result = results[str(i)]
+            
+            if success:
+                print(f"  ✓ {recipient_email} ({account_name})")
+                send_log.add([timestamp, recipient_email, recipient_name, account_name, 'sent', result])
+                batch_sent += 1
+                total_sent += 1
+            else:
+                print(f"  ✗ {recipient_email} ({account_name}): {result}")
+                send_log.add([timestamp, recipient_email, recipient_name, account_name, 'failed', result])
+                total_failed += 1
         
-        log_file_handle.flush()
-        session_count += 1
+        if batch_sent < len(batch_emails):
+            account_manager.release_sends(account_name, len(batch_emails) - batch_sent)
         
-        # Anti-spam delays
-        if session_count >= emails_per_session:
-            # Take a longer break
+        # Pace per batch: one throttled batch backs off even if its retries went through
+        if throttled or batch_sent:
+            account_manager.record_result(account_name, throttled)
+        
+        # Anti-spam delay, per account; rest only once fully backed off
+        if account_manager.needs_pause(account_name):
             break_time = random.randint(300, 600)  # 5-10 minutes
-            print(f"\n⏸ Taking a {break_time//60} minute break after {session_count} emails...")
-            time.sleep(break_time)
-            session_count = 0
+            print(f"\n⏸ {account_name} is being rate limited, pausing it for {break_time//60} minutes...")
+            paused.add(account_name)
+            next_send_at[account_name] = time.time() + break_time
         else:
-            # Normal delay between emails
-            delay = random.uniform(min_delay, max_delay)
-            time.sleep(delay)
+            next_send_at[account_name] = time.time() + account_manager.next_delay(account_name)
+        
+        # The log is the resume record: write the batch out before waiting
+        send_log.flush()
+    
+    # One worker per account: each account has its own HTTP connection and
+    # at most one batch in flight, so accounts send in parallel. The log is
+    # closed (and the SIGTERM handler restored) however the run ends.
+    with send_log, ThreadPoolExecutor(max_workers=max(len(account_manager.accounts), 1)) as executor:
+        while position < len(pending_emails) or in_flight:
+            # Batches already submitted go out regardless, so on Ctrl-C wait
+            # for them and log their results before stopping
+            try:
+                # Start a batch on every idle account whose own delay is up. Other
+                # sender processes may share an account's quota, so each batch is
+                # claimed before it is built
+                now = time.time()
+                available = account_manager.get_available_accounts()
+                for account_name, service, sender_email in available:
+                    if position >= len(pending_emails):
+                        break
+                    if account_name in in_flight or next_send_at.get(account_name, 0) > now:
+                        continue
+                    if account_name in paused:
+                        paused.discard(account_name)
+                        account_manager.end_pause(account_name)
+                    
+                    batch_emails = pending_emails[position:position + batch_size]
+                    reserved = account_manager.reserve_sends(account_name, len(batch_emails))
+                    if not reserved:
+                        continue
+                    batch_emails = batch_emails[:reserved]
+                    position += len(batch_emails)
+                    
+                    # Start reading the next batch's attachments from disk
+                    # while this one is built and sent
+                    prefetch_attachments(e.pdf_path for e in pending_emails[position:position + batch_size])
+                    
+                    print(f"[{submitted + 1}-{submitted + len(batch_emails)}/{len(pending_emails)}] "
+                          f"Sending via {account_name}...")
+                    submitted += len(batch_emails)
+                    
+                    try:
+                        results = {}
+                        messages = {}
+                        for i, email_data in enumerate(batch_emails):
+                            try:
+                                messages[str(i)] = create_personalized_email(
+                                    sender_email, email_data.email, email_data.name,
+                                    subject, body_template, email_data.pdf_path,
+                                    shared=attachment_uses[email_data.pdf_path] > 1
+                                )
+                            except Exception as e:
+                                results[str(i)] = (False, str(e))
+                        
+                        future = executor.submit(send_email_batch, service, messages) if messages else None
+                        in_flight[account_name] = (batch_emails, results, future)
+                    except BaseException:
+                        # Interrupted before the batch was submitted: give its claim back
+                        account_manager.release_sends(account_name, reserved)
+                        raise
+                    if future is None:
+                        finish(account_name)
+                
+                if not in_flight:
+                    if not available:
+                        print("\n⚠ All accounts have reached daily limit. Try again tomorrow.")
+                        break
+                    # Every account with quota left is waiting out its delay
+                    time.sleep(max(min(next_send_at.get(name, 0) for name, _, _ in available) - time.time(), 0))
+                    continue
+                
+                # Wake when a batch finishes or an idle account's delay is up
+                idle = [next_send_at.get(name, 0) for name, _, _ in available if name not in in_flight]
+                timeout = None
+                if idle and position < len(pending_emails):
+                    timeout = max(min(idle) - time.time(), 0)
+                done, _ = wait([entry[2] for entry in in_flight.values()], timeout=timeout,
+                               return_when=FIRST_COMPLETED)
+            except KeyboardInterrupt:
+                print("\n⏹ Interrupted, finishing batches already in progress...")
+                interrupted = True
+                done, _ = wait([entry[2] for entry in in_flight.values() if entry[2] is not None])
+            
+            for account_name in [name for name, entry in in_flight.items() if entry[2] is None or entry[2] in done]:
+                finish(account_name)
+            if interrupted:
+                break
     
-    log_file_handle.close()
+    account_manager.save_progress()
     
     print(f"\n{'='*60}")
     print(f"Session Complete")
@@ -353,9 +496,8 @@ Your Name
 """
     
     # Anti-spam settings (conservative for safety)
-    MIN_DELAY = 20  # Minimum seconds between emails
-    MAX_DELAY = 60  # Maximum seconds between emails
-    EMAILS_PER_SESSION = 100  # Take a break after this many
+    MIN_DELAY = 20  # Minimum seconds between batches (starting pace)
+    MAX_DELAY = 60  # Pace after a rate-limit pause (backs off up to 5x this)
     DAILY_LIMIT_PER_ACCOUNT = 400  # Conservative (Gmail allows 500)
     
     # =======================================================
@@ -374,8 +516,8 @@ Your Name
             subject=SUBJECT,
             body_template=BODY,
             min_delay=MIN_DELAY,
-            max_delay=MAX_DELAY,
-            emails_per_session=EMAILS_PER_SESSION
+            max_delay=MAX_DELAY
         )
+        manager.close()
     else:
         print("No accounts configured. Please set up Gmail API credentials first.")
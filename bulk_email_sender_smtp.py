@@ -10,25 +10,33 @@ Setup:
   4. Add them to credentials/accounts.json
 """
 
-import csv
+import re
 import json
-import time
 import random
-import pickle
 import smtplib
 import ssl
+import queue
+import threading
 from pathlib import Path
-from email.mime.text import MIMEText
-from email.mime.multipart import MIMEMultipart
-from email.mime.base import MIMEBase
-from email import encoders
+from collections import Counter
 from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+
+from sender_common import (
+    BaseAccountManager, SendLog, build_personalized_message, load_pending_emails, prefetch_attachments,
+)
 
 
 ACCOUNTS_FILE = "credentials/accounts.json"
 
+# Same line-ending and dot-stuffing rules smtplib applies to DATA
+_EOL_RE = re.compile(br'(?:\r\n|\n|\r(?!\n))')
+_LEADING_DOT_RE = re.compile(br'(?m)^\.')
+
+# SMTP replies that mean "slow down / try later" rather than a bad message
+THROTTLE_CODES = {421, 450, 451, 452, 454}
 
-class GmailAccountManager:
+class GmailAccountManager(BaseAccountManager):
     """Manages multiple Gmail accounts and their sending quotas."""
 
     def __init__(self, accounts_file=ACCOUNTS_FILE, daily_limit=450):
@@ -38,38 +46,17 @@ class GmailAccountManager:
             daily_limit: Conservative daily limit per account (Gmail allows 500)
         """
         self.accounts_file = Path(accounts_file)
-        self.daily_limit = daily_limit
-        self.accounts = {}          # name -> {email, password}
         self.connections = {}       # name -> smtplib.SMTP_SSL
-        self.send_counts = {}
-        self.progress_file = self.accounts_file.parent / "send_progress_smtp.pickle"
-        self.load_progress()
-
-    # ---- progress tracking ----
-
-    def load_progress(self):
-        """Load sending progress from file."""
-        if self.progress_file.exists():
-            with open(self.progress_file, 'rb') as f:
-                data = pickle.load(f)
-                if data.get('date') == datetime.now().date():
-                    self.send_counts = data.get('counts', {})
-                else:
-                    self.send_counts = {}
-
-    def save_progress(self):
-        """Save sending progress to file."""
-        with open(self.progress_file, 'wb') as f:
-            pickle.dump({
-                'date': datetime.now().date(),
-                'counts': self.send_counts
-            }, f)
+        super().__init__(self.accounts_file.parent / "send_progress_smtp.pickle", daily_limit)
 
     # ---- account setup ----
 
     def load_accounts(self):
         """Load accounts from JSON and verify SMTP login for each."""
-        if not self.accounts_file.exists():
+        try:
+            with open(self.accounts_file) as f:
+                account_list = json.load(f)
+        except FileNotFoundError:
             self.accounts_file.parent.mkdir(parents=True, exist_ok=True)
             sample = [
                 {"email": "you@gmail.com", "app_password": "xxxx xxxx xxxx xxxx"},
@@ -81,33 +68,40 @@ class GmailAccountManager:
             print("Edit it with your real Gmail addresses and app passwords, then re-run.")
             return False
 
-        with open(self.accounts_file) as f:
-            account_list = json.load(f)
-
         if not account_list:
             print("No accounts found in accounts.json")
             return False
 
+        # Log in to all accounts at once; each TLS handshake + LOGIN is a
+        # few hundred ms of waiting on the network.
         context = ssl.create_default_context()
-
-        for entry in account_list:
-            email = entry["email"]
-            password = entry["app_password"]
-            name = email.split("@")[0]
-
-            try:
-                server = smtplib.SMTP_SSL("smtp.gmail.com", 465, context=context)
-                server.login(email, password)
-                self.accounts[name] = {"email": email, "password": password}
-                self.connections[name] = server
-                if name not in self.send_counts:
-                    self.send_counts[name] = 0
-                print(f"✓ {email} logged in ({self.send_counts[name]}/{self.daily_limit} sent today)")
-            except Exception as e:
-                print(f"✗ {email} login failed: {e}")
+        with ThreadPoolExecutor(max_workers=min(len(account_list), 16)) as pool:
+            results = list(pool.map(lambda entry: self._login_one(entry, context), account_list))
+
+        for result in results:
+            if result is None:
+                continue
+            name, info, server = result
+            self.accounts[name] = info
+            self.connections[name] = server
+            if name not in self.send_counts:
+                self.send_counts[name] = 0
+            print(f"✓ {info['email']} logged in ({self.send_counts[name]}/{self.daily_limit} sent today)")
 
         return len(self.accounts) > 0
 
+    def _login_one(self, entry, context):
+        """Open and log in an SMTP connection for one accounts.json entry."""
+        email = entry["email"]
+        password = entry["app_password"]
+        try:
+            server = smtplib.SMTP_SSL("smtp.gmail.com", 465, context=context)
+            server.login(email, password)
+        except Exception as e:
+            print(f"✗ {email} login failed: {e}")
+            return None
+        return email.split("@")[0], {"email": email, "password": password}, server
+
     def _reconnect(self, account_name):
         """Re-establish SMTP connection for an account."""
         info = self.accounts[account_name]
@@ -116,29 +110,9 @@ class GmailAccountManager:
         server.login(info["email"], info["password"])
         self.connections[account_name] = server
 
-    def get_available_account(self):
-        """Get an account that hasn't reached its daily limit."""
-        available = [
-            name for name, count in self.send_counts.items()
-            if count < self.daily_limit
-        ]
-        if not available:
-            return None, None, None
-
-        account_name = min(available, key=lambda x: self.send_counts[x])
-        return account_name, self.accounts[account_name]["email"], self.connections[account_name]
-
-    def record_send(self, account_name):
-        """Record that an email was sent from an account."""
-        self.send_counts[account_name] = self.send_counts.get(account_name, 0) + 1
-        self.save_progress()
-
-    def get_total_capacity(self):
-        """Get total remaining capacity across all accounts."""
-        return sum(self.daily_limit - c for c in self.send_counts.values())
-
     def close_all(self):
-        """Close all SMTP connections."""
+        """Save progress and close all SMTP connections."""
+        self.save_progress()
         for server in self.connections.values():
             try:
                 server.quit()
@@ -146,40 +120,82 @@ class GmailAccountManager:
                 pass
 
 
-def create_email_with_attachment(sender, to, subject, body, attachment_path):
-    """Create an email message with attachment."""
-    message = MIMEMultipart()
-    message['To'] = to
-    message['From'] = sender
-    message['Subject'] = subject
-
-    message.attach(MIMEText(body, 'plain'))
-
-    attachment_path = Path(attachment_path)
-    if attachment_path.exists():
-        with open(attachment_path, 'rb') as f:
-            part = MIMEBase('application', 'octet-stream')
-            part.set_payload(f.read())
-        encoders.encode_base64(part)
-        part.add_header(
-            'Content-Disposition',
-            f'attachment; filename="{attachment_path.name}"'
-        )
-        message.attach(part)
-    else:
-        raise FileNotFoundError(f"Attachment not found: {attachment_path}")
-
-    return message
+def fast_sendmail(server, sender, to, msg):
+    """
+    Send one message over an open SMTP session.
 
+    When the server advertises PIPELINING (RFC 2920), MAIL FROM, RCPT TO and
+    DATA go out in a single write and their replies are read back together,
+    saving two round-trips per email. Otherwise falls back to sendmail().
+    The session is only RSET after an error.
+    """
+    # The pipelined commands bypass smtplib's own checks, so a line break
+    # in an address (e.g. from the CSV) must not reach the wire
+    for address in (sender, to):
+        if '\r' in address or '\n' in address:
+            raise ValueError(f"Invalid address (contains a line break): {address!r}")
+
+    data = _EOL_RE.sub(b'\r\n', msg)
+
+    if not server.has_extn('pipelining'):
+        server.sendmail(sender, to, data)
+        return
+
+    server.send(
+        f'MAIL FROM:{smtplib.quoteaddr(sender)}\r\n'
+        f'RCPT TO:{smtplib.quoteaddr(to)}\r\n'
+        'DATA\r\n'
+    )
+    mail_code, mail_resp = server.getreply()
+    rcpt_code, rcpt_resp = server.getreply()
+    data_code, data_resp = server.getreply()
+
+    if mail_code != 250 or rcpt_code not in (250, 251) or data_code != 354:
+        if data_code == 354:
+            # Server is already waiting for a message; end it empty
+            server.send(b'.\r\n')
+            server.getreply()
+        server.rset()
+        if mail_code != 250:
+            raise smtplib.SMTPSenderRefused(mail_code, mail_resp, sender)
+        if rcpt_code not in (250, 251):
+            raise smtplib.SMTPRecipientsRefused({to: (rcpt_code, rcpt_resp)})
+        raise smtplib.SMTPDataError(data_code, data_resp)
+
+    data = _LEADING_DOT_RE.sub(b'..', data)
+    if not data.endswith(b'\r\n'):
+        data += b'\r\n'
+    server.send(data + b'.\r\n')
+    code, resp = server.getreply()
+    if code != 250:
+        server.rset()
+        raise smtplib.SMTPDataError(code, resp)
+
+
+def _is_throttled(error):
+    """Check whether an SMTP error means the server wants us to slow down."""
+    if isinstance(error, smtplib.SMTPRecipientsRefused):
+        return any(code in THROTTLE_CODES for code, _ in error.recipients.values())
+    return isinstance(error, smtplib.SMTPResponseException) and error.smtp_code in THROTTLE_CODES
+
+
+def send_email(server, sender, to, name, subject_template, body_template, attachment_path,
+               shared=False):
+    """
+    Send a personalized email via SMTP.
 
-def send_email(server, sender, to, subject, body, attachment_path):
-    """Send an email via SMTP."""
+    Returns:
+        (success, detail, throttled) where throttled means the server asked
+        us to slow down
+    """
     try:
-        message = create_email_with_attachment(sender, to, subject, body, attachment_path)
-        server.sendmail(sender, to, message.as_string())
-        return True, "ok"
+        message = build_personalized_message(
+            sender, to, name, subject_template, body_template, attachment_path, shared
+        )
+        fast_sendmail(server, sender, to, message)
+        return True, "ok", False
     except Exception as e:
-        return False, str(e)
+        return False, str(e), _is_throttled(e)
 
 
 def bulk_send_emails(
@@ -189,7 +205,6 @@ def bulk_send_emails(
     body_template,
     min_delay=15,
     max_delay=45,
-    emails_per_session=150,
     log_file="send_log.csv"
 ):
     """
@@ -200,108 +215,152 @@ def bulk_send_emails(
         email_list_csv: CSV file with columns: email, name, pdf_path
         subject: Email subject (can use {name} placeholder)
         body_template: Email body (can use {name} placeholder)
-        min_delay: Minimum seconds between emails
-        max_delay: Maximum seconds between emails
-        emails_per_session: Max emails before taking a longer break
+        min_delay: Starting (and lowest) seconds between emails from the same account
+        max_delay: Seconds between emails an account resumes at after a pause;
+            delays back off up to 5x this when Gmail pushes back
         log_file: File to log sent/failed emails
-    """
-    # Load email list
-    with open(email_list_csv, 'r', encoding='utf-8') as f:
-        reader = csv.DictReader(f)
-        pending_emails = list(reader)
 
+    Accounts send in parallel, one worker thread per SMTP connection.
+    """
     # Load already sent emails
-    sent_emails = set()
-    log_path = Path(log_file)
-    if log_path.exists():
-        with open(log_path, 'r', encoding='utf-8') as f:
-            reader = csv.DictReader(f)
-            for row in reader:
-                if row.get('status') == 'sent':
-                    sent_emails.add(row['email'])
-
-    # Filter out already sent
-    pending_emails = [e for e in pending_emails if e['email'] not in sent_emails]
+    send_log = SendLog(log_file, ['timestamp', 'email', 'name', 'account_used', 'status', 'detail'])
+
+    # Load email list, minus already sent
+    pending_emails = load_pending_emails(email_list_csv, send_log.sent_emails)
+
+    # Only attachments several recipients share are worth encoding once and
+    # caching; each one-off PDF is built directly
+    attachment_uses = Counter(e.pdf_path for e in pending_emails)
 
     print(f"\n{'='*60}")
     print(f"Bulk Email Sender (SMTP)")
     print(f"{'='*60}")
     print(f"Total pending: {len(pending_emails)}")
-    print(f"Already sent: {len(sent_emails)}")
+    print(f"Already sent: {len(send_log.sent_emails)}")
     print(f"Daily capacity remaining: {account_manager.get_total_capacity()}")
     print(f"{'='*60}\n")
 
-    # Open log file for appending
-    log_exists = log_path.exists()
-    log_file_handle = open(log_path, 'a', newline='', encoding='utf-8')
-    log_writer = csv.writer(log_file_handle)
-    if not log_exists:
-        log_writer.writerow(['timestamp', 'email', 'name', 'account_used', 'status', 'detail'])
-
-    session_count = 0
-    total_sent = 0
-    total_failed = 0
-
+    # Assign emails to per-account queues, always to the account with the
+    # most remaining capacity so the load stays balanced
+    capacity = {
+        name: account_manager.daily_limit - account_manager.send_counts.get(name, 0)
+        for name in account_manager.connections
+    }
+    work_queues = {name: queue.Queue() for name in account_manager.connections}
+    assigned = 0
     for email_data in pending_emails:
-        account_name, sender_email, server = account_manager.get_available_account()
-
-        if not server:
-            print("\n⚠ All accounts have reached daily limit. Try again tomorrow.")
+        name = max(capacity, key=capacity.get, default=None)
+        if name is None or capacity[name] <= 0:
+            print("⚠ Not enough daily capacity for all pending emails; the rest will wait until tomorrow.\n")
             break
+        work_queues[name].put(email_data)
+        capacity[name] -= 1
+        assigned += 1
 
-        recipient_email = email_data['email']
-        recipient_name = email_data.get('name', '')
-        attachment_path = email_data['pdf_path']
+    log_lock = threading.Lock()
+    stop_event = threading.Event()
+    totals = {'sent': 0, 'failed': 0}
 
-        personalized_subject = subject.replace('{name}', recipient_name)
-        personalized_body = body_template.replace('{name}', recipient_name)
+    def send_worker(account_name, work_queue):
+        """Send every email queued for one account over its own connection."""
+        sender_email = account_manager.accounts[account_name]["email"]
 
-        print(f"[{total_sent + total_failed + 1}/{len(pending_emails)}] "
-              f"Sending to {recipient_email} via {sender_email}...", end=" ")
+        while not stop_event.is_set():
+            try:
+                email_data = work_queue.get_nowait()
+            except queue.Empty:
+                break
+
+            # Start reading this account's next attachment from disk while
+            # this email is sent and the delay runs. Only this worker takes
+            # from its queue, so peeking at the head is safe
+            if not work_queue.empty():
+                prefetch_attachments([work_queue.queue[0].pdf_path])
+
+            # Other sender processes may share this account's quota, so the
+            # startup split is only a plan: claim each send before making it
+            if not account_manager.reserve_sends(account_name):
+                with log_lock:
+                    print(f"\n⚠ {sender_email} has reached its daily limit; "
+                          f"its remaining emails will wait until tomorrow.")
+                break
+
+            recipient_email = email_data.email
+            recipient_name = email_data.name
+            attachment_path = email_data.pdf_path
+            shared = attachment_uses[attachment_path] > 1
+
+            success, result, throttled = send_email(
+                account_manager.connections[account_name], sender_email, recipient_email,
+                recipient_name, subject, body_template, attachment_path, shared
+            )
+
+            # Reconnect once and retry on SMTP failure
+            if not success and ("SMTPServerDisconnected" in result or "Connection" in result):
+                try:
+                    account_manager._reconnect(account_name)
+                    success, result, throttled = send_email(
+                        account_manager.connections[account_name], sender_email, recipient_email,
+                        recipient_name, subject, body_template, attachment_path, shared
+                    )
+                except Exception as e:
+                    result = str(e)
+
+            timestamp = datetime.now().isoformat()
+
+            with log_lock:
+                count = totals['sent'] + totals['failed'] + 1
+                print(f"[{count}/{assigned}] {recipient_email} via {sender_email}", end=" ")
+                if success:
+                    print("✓")
+                    send_log.add([timestamp, recipient_email, recipient_name, sender_email, 'sent', result])
+                    totals['sent'] += 1
+                else:
+                    print(f"✗ {result}")
+                    account_manager.release_sends(account_name)
+                    send_log.add([timestamp, recipient_email, recipient_name, sender_email, 'failed', result])
+                    totals['failed'] += 1
+                # The log is the resume record, so each row is written out
+                # before the worker goes on to wait for the next send
+                send_log.flush()
+                # Only real successes count towards speeding back up
+                if success or throttled:
+                    account_manager.record_result(account_name, throttled)
+
+            if work_queue.empty():
+                break
+
+            # Anti-spam delays, adapted per account; rest only once fully backed off
+            if account_manager.needs_pause(account_name):
+                break_time = random.randint(300, 600)  # 5-10 minutes
+                with log_lock:
+                    print(f"\n⏸ {sender_email} is being rate limited, pausing it for {break_time//60} minutes...")
+                stop_event.wait(break_time)
+                account_manager.end_pause(account_name)
+            else:
+                stop_event.wait(account_manager.next_delay(account_name))
+
+    account_manager.reset_pacing(min_delay, max_delay)
+
+    # The log is closed (and the SIGTERM handler restored) however the run
+    # ends; the executor exits first, so every worker is done writing by then
+    with send_log, ThreadPoolExecutor(max_workers=max(len(account_manager.connections), 1)) as executor:
+        futures = [
+            executor.submit(send_worker, name, work_queue)
+            for name, work_queue in work_queues.items()
+            if not work_queue.empty()
+        ]
+        try:
+            for future in futures:
+                future.result()
+        except KeyboardInterrupt:
+            print("\n⏹ Interrupted, finishing emails already in progress...")
+        finally:
+            stop_event.set()
 
-        success, result = send_email(
-            server, sender_email, recipient_email,
-            personalized_subject, personalized_body, attachment_path
-        )
+    total_sent = totals['sent']
+    total_failed = totals['failed']
 
-        # Reconnect once and retry on SMTP failure
-        if not success and ("SMTPServerDisconnected" in result or "Connection" in result):
-            try:
-                account_manager._reconnect(account_name)
-                server = account_manager.connections[account_name]
-                success, result = send_email(
-                    server, sender_email, recipient_email,
-                    personalized_subject, personalized_body, attachment_path
-                )
-            except Exception as e:
-                result = str(e)
-
-        timestamp = datetime.now().isoformat()
-
-        if success:
-            print("✓")
-            account_manager.record_send(account_name)
-            log_writer.writerow([timestamp, recipient_email, recipient_name, sender_email, 'sent', result])
-            total_sent += 1
-        else:
-            print(f"✗ {result}")
-            log_writer.writerow([timestamp, recipient_email, recipient_name, sender_email, 'failed', result])
-            total_failed += 1
-
-        log_file_handle.flush()
-        session_count += 1
-
-        # Anti-spam delays
-        if session_count >= emails_per_session:
-            break_time = random.randint(300, 600)  # 5-10 minutes
-            print(f"\n⏸ Taking a {break_time//60} minute break after {session_count} emails...")
-            time.sleep(break_time)
-            session_count = 0
-        else:
-            delay = random.uniform(min_delay, max_delay)
-            time.sleep(delay)
-
-    log_file_handle.close()
     account_manager.close_all()
 
     print(f"\n{'='*60}")
@@ -332,9 +391,8 @@ Your Name
 """
 
     # Anti-spam settings (conservative for safety)
-    MIN_DELAY = 20        # Minimum seconds between emails
-    MAX_DELAY = 60        # Maximum seconds between emails
-    EMAILS_PER_SESSION = 100   # Take a break after this many
+    MIN_DELAY = 20        # Minimum seconds between emails per account (starting pace)
+    MAX_DELAY = 60        # Pace after a rate-limit pause (backs off up to 5x this)
     DAILY_LIMIT = 400     # Conservative (Gmail allows 500)
 
     # =======================================================
@@ -352,7 +410,6 @@ Your Name
             body_template=BODY,
             min_delay=MIN_DELAY,
             max_delay=MAX_DELAY,
-            emails_per_session=EMAILS_PER_SESSION,
         )
     else:
         print("No accounts configured. See credentials/accounts.json")
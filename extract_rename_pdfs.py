@@ -3,19 +3,169 @@ PDF Data Extraction and Renaming Script
 Extracts name and Gmail from PDFs, then renames the files accordingly.
 """
 
+import gc
 import os
+import errno
+import logging
 import re
-import pdfplumber
+import shutil
+import io
 import csv
 from pathlib import Path
+from contextlib import closing, ExitStack
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+from pdfminer.converter import TextConverter
+from pdfminer.layout import LAParams
+from pdfminer.pdfinterp import PDFPageInterpreter, PDFResourceManager
+from pdfminer.pdfpage import PDFPage
+
+try:
+    from pypdf import PdfReader
+except ImportError:  # optional: pdfminer handles everything, just slower
+    PdfReader = None
+
+try:
+    import re2  # google-re2: linear-time matching
+except ImportError:  # optional: falls back to the stdlib re module
+    re2 = None
+
+try:
+    from tqdm import tqdm
+    from tqdm.contrib.logging import logging_redirect_tqdm
+except ImportError:  # optional: progress bar only
+    tqdm = None
+
+log = logging.getLogger(__name__)
+
+
+COPY_WORKERS = 4                 # copy threads; copies are I/O-bound
+COPY_BACKLOG = 2 * COPY_WORKERS  # copies in flight before the main loop waits
+
+# os.link failures that just mean "copy instead": other filesystem, or
+# hard links not allowed/supported there
+LINK_FALLBACK_ERRNOS = {errno.EXDEV, errno.EPERM, errno.ENOTSUP, errno.EOPNOTSUPP, errno.EMLINK}
+
+NO_GMAIL = 'No Gmail found'
+NAME_SEARCH_CHARS = 2048  # how much of the first page to check for a name first
+GC_PAGE_THRESHOLD = 100  # collect garbage after PDFs with more pages than this
+
+# Pattern for Gmail addresses
+EMAIL_PATTERN = r'[a-zA-Z0-9._%+-]+@gmail\.com'
+# RE2 scans in guaranteed linear time, which helps on long pages with no
+# address. It has no lookaheads, so the name patterns below stay on re.
+if re2 is not None:
+    EMAIL_RE = re2.compile(f'(?i){EMAIL_PATTERN}')
+else:
+    EMAIL_RE = re.compile(EMAIL_PATTERN, re.IGNORECASE)
+
+# Characters allowed before '@gmail.com' (the class in EMAIL_PATTERN)
+EMAIL_CHARS = frozenset('abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789._%+-')
+FAST_EMAIL_SCAN_CHARS = 4096  # pages up to this size skip the email regex
+
+# Common name patterns - adjust based on your PDF format. All labels are
+# matched in a single pass; "Full Name:" is covered by the Name label.
+# The name itself sits in a lookahead so a match never swallows the start
+# of an email address that follows it.
+NAME_PATTERN = (
+    r'(?:(?P<label>Name|Recipient|To)[:\s]+|(?P<dear>Dear)\s+)'
+    r'(?=(?P<name>[A-Za-z]+\s+[A-Za-z]+))'
+)
+NAME_RE = re.compile(NAME_PATTERN, re.IGNORECASE)
+# Rest of the word a NAME_SEARCH_CHARS cut lands in
+WORD_TAIL_RE = re.compile(r'\S*')
+
+# Email and name labels together, so a page is scanned only once
+TEXT_RE = re.compile(f'(?P<email>{EMAIL_PATTERN})|{NAME_PATTERN}', re.IGNORECASE)
+# Lower rank wins when a PDF contains more than one label
+NAME_LABEL_RANK = {'name': 0, 'recipient': 1, 'dear': 2, 'to': 3}
+
+# Filename-safe names: drop everything but word characters, whitespace and
+# '-', and turn spaces into underscores. Latin-1 names (the common case) go
+# through a precomputed translate table built from the regex itself; other
+# names fall back to the regex.
+SAFE_NAME_RE = re.compile(r'[^\w\s-]')
+SAFE_NAME_TRANS = str.maketrans({
+    ' ': '_',
+    **{chr(c): None for c in range(256) if SAFE_NAME_RE.match(chr(c))},
+})
+# john.doe / john_doe -> john doe, for names taken from the email username
+USERNAME_TRANS = str.maketrans('._', '  ')
+
+
+def fast_find_gmail(text):
+    """
+    Find the first Gmail address in ASCII text with str.find instead of the
+    regex engine. Gives the same result as EMAIL_RE.search for ASCII input
+    (where lower() keeps every index in place).
+    """
+    lowered = text.lower()
+    start = 0
+    while True:
+        at = lowered.find('@gmail.com', start)
+        if at < 0:
+            return None
+        begin = at
+        while begin > 0 and text[begin - 1] in EMAIL_CHARS:
+            begin -= 1
+        if begin < at:
+            return text[begin:at + len('@gmail.com')]
+        start = at + 1
 
 
 def extract_email_from_text(text):
     """Extract Gmail address from text."""
-    # Pattern for Gmail addresses
-    email_pattern = r'[a-zA-Z0-9._%+-]+@gmail\.com'
-    matches = re.findall(email_pattern, text, re.IGNORECASE)
-    return matches[0] if matches else None
+    if len(text) <= FAST_EMAIL_SCAN_CHARS and text.isascii():
+        return fast_find_gmail(text)
+    match = EMAIL_RE.search(text)
+    return match.group(0) if match else None
+
+
+def _name_rank(match):
+    """Rank of the label a NAME_RE/TEXT_RE name match was found by."""
+    return NAME_LABEL_RANK[(match.group('label') or match.group('dear')).lower()]
+
+
+def extract_email_and_name(text):
+    """
+    Find the first Gmail address and the best-ranked labelled name in a
+    single pass over text. Returns (email, rank, name) as in _find_name;
+    any of them may be None, and there is no email fallback.
+    """
+    # Most pages hold no address at all; a plain substring check is much
+    # cheaper than the combined regex, so those pages only look for a name
+    if '@' not in text or '@gmail.com' not in text.lower():
+        return (None, *_find_name(text))
+    
+    email = None
+    best_rank, best_name = None, None
+    for match in TEXT_RE.finditer(text):
+        if match.group('email'):
+            if email is None:
+                email = match.group('email')
+        else:
+            rank = _name_rank(match)
+            if best_rank is None or rank < best_rank:
+                best_rank, best_name = rank, match.group('name')
+        if email and best_rank == 0:
+            break
+    return email, best_rank, best_name.strip() if best_name else None
+
+
+def _find_name(text):
+    """
+    Best-ranked labelled name in text and the rank of its label (see
+    NAME_LABEL_RANK), or (None, None) if there is none.
+    """
+    best_rank, best_name = None, None
+    for match in NAME_RE.finditer(text):
+        rank = _name_rank(match)
+        if best_rank is None or rank < best_rank:
+            best_rank, best_name = rank, match.group('name')
+            if rank == 0:
+                break
+    return best_rank, best_name.strip() if best_name else None
 
 
 def extract_name_from_text(text, email=None):
@@ -23,137 +173,352 @@ def extract_name_from_text(text, email=None):
     Extract name from text. 
     Customize this based on your PDF structure.
     """
-    # Common patterns - adjust based on your PDF format
-    patterns = [
-        r'Name[:\s]+([A-Za-z]+\s+[A-Za-z]+)',
-        r'Full Name[:\s]+([A-Za-z]+\s+[A-Za-z]+)',
-        r'Recipient[:\s]+([A-Za-z]+\s+[A-Za-z]+)',
-        r'Dear\s+([A-Za-z]+\s+[A-Za-z]+)',
-        r'To[:\s]+([A-Za-z]+\s+[A-Za-z]+)',
-    ]
-    
-    for pattern in patterns:
-        match = re.search(pattern, text, re.IGNORECASE)
-        if match:
-            return match.group(1).strip()
+    _, name = _find_name(text)
+    if name:
+        return name
     
     # If email exists, try to extract name from email
     if email:
         username = email.split('@')[0]
         # Convert john.doe or john_doe to John Doe
-        name = re.sub(r'[._]', ' ', username).title()
+        name = username.translate(USERNAME_TRANS).title()
         return name
     
     return None
 
 
+def _safe_name(name):
+    """Filename-safe version of name (see SAFE_NAME_TRANS)."""
+    if max(name) <= '\xff':
+        return name.translate(SAFE_NAME_TRANS)
+    return SAFE_NAME_RE.sub('', name).replace(' ', '_')
+
+
+def _copy_bytes(src, dst, bufsize=1 << 20):
+    """
+    Byte-for-byte copy of src to dst. Uses os.sendfile (copied inside the
+    kernel) where available, otherwise reads into a reusable 1 MiB buffer,
+    which is faster than shutil's default 64 KiB for large PDFs.
+    Raises FileExistsError rather than overwrite an existing dst.
+    """
+    with open(src, 'rb') as fsrc, open(dst, 'xb') as fdst:
+        if hasattr(os, 'sendfile'):
+            try:
+                size = os.fstat(fsrc.fileno()).st_size
+                offset = 0
+                while offset < size:
+                    sent = os.sendfile(fdst.fileno(), fsrc.fileno(), offset, size - offset)
+                    if not sent:
+                        break
+                    offset += sent
+                return
+            except OSError:  # e.g. sendfile not supported for these files
+                fdst.seek(0)
+                fdst.truncate()
+        
+        buf = bytearray(bufsize)
+        view = memoryview(buf)
+        while True:
+            n = fsrc.readinto(buf)
+            if not n:
+                break
+            fdst.write(view[:n])
+
+
+def _fast_copy(src, dst):
+    """
+    Copy src to dst as cheaply as the filesystem allows: a hard link when
+    both are on the same filesystem (no data is copied at all), then an
+    in-kernel copy_file_range (reflink/server-side copy where supported),
+    and finally a plain byte copy. File metadata is copied as copy2 would.
+    An existing dst is never overwritten: FileExistsError propagates (on a
+    case-insensitive filesystem two names can map to the same file).
+    """
+    try:
+        os.link(src, dst)
+        return
+    except OSError as e:
+        if e.errno not in LINK_FALLBACK_ERRNOS:
+            raise
+    
+    if hasattr(os, 'copy_file_range'):
+        try:
+            with open(src, 'rb') as fsrc, open(dst, 'xb') as fdst:
+                try:
+                    remaining = os.fstat(fsrc.fileno()).st_size
+                    while remaining > 0:
+                        copied = os.copy_file_range(fsrc.fileno(), fdst.fileno(), remaining)
+                        if not copied:
+                            break
+                        remaining -= copied
+                except OSError:
+                    # Not supported here; drop the partial file we created
+                    # and fall back to a plain copy below
+                    fdst.close()
+                    os.remove(dst)
+                    raise
+            shutil.copystat(src, dst)
+            return
+        except FileExistsError:
+            raise
+        except OSError:
+            pass
+    
+    _copy_bytes(src, dst)
+    shutil.copystat(src, dst)
+
+
+def _pdfminer_page_text(resources, page):
+    """
+    Text of one page via pdfminer.six directly. This skips pdfplumber's
+    per-character objects and word clustering, but keeps pdfminer's line
+    grouping: without it lines run together ("John SmithEmail: ...") and
+    the name regex would pick up the next line's first word.
+    """
+    out = io.StringIO()
+    device = TextConverter(resources, out, laparams=LAParams())
+    try:
+        PDFPageInterpreter(resources, device).process_page(page)
+    finally:
+        device.close()
+    return out.getvalue()
+
+
+def _iter_page_texts(pdf_path):
+    """
+    Yield the text of each page in turn. Uses pypdf's plain text extraction
+    when it is installed, since layout analysis is not needed for regex
+    matching; pages where pypdf finds no text (and every page, without
+    pypdf) go through pdfminer.
+    """
+    resources = PDFResourceManager(caching=True)
+    
+    if PdfReader is None:
+        with open(pdf_path, 'rb') as fp:
+            for page in PDFPage.get_pages(fp):
+                yield _pdfminer_page_text(resources, page)
+        return
+    
+    with ExitStack() as stack:
+        miner_pages = None
+        for i, page in enumerate(PdfReader(pdf_path).pages):
+            text = page.extract_text() or ''
+            if not text.strip():
+                if miner_pages is None:
+                    fp = stack.enter_context(open(pdf_path, 'rb'))
+                    miner_pages = list(PDFPage.get_pages(fp))
+                text = _pdfminer_page_text(resources, miner_pages[i])
+            yield text
+
+
+def _process_one(pdf_path):
+    """
+    Extract email and name from a single PDF. Runs in a worker process,
+    so it only reads the PDF; renaming happens back in process_pdfs.
+    Returns {'email', 'name'} on success or {'error'} on failure.
+    """
+    email = name = None
+    pages_read = 0
+    try:
+        with closing(_iter_page_texts(pdf_path)) as pages:
+            # Extract text page by page and stop as soon as both the email
+            # and a Name-labelled name have turned up; later pages are never
+            # parsed. Names under weaker labels are kept only until a better
+            # ranked one is found on a later page.
+            name_rank = None
+            first_page = True
+            for pages_read, text in enumerate(pages, 1):
+                if not text:
+                    continue
+                if first_page:
+                    first_page = False
+                    # A Name label almost always sits at the top of the first
+                    # page; only scan whole pages if it isn't there, since a
+                    # weaker label there ("to the program") may be outranked
+                    # further down. The cut is moved to the end of a word so
+                    # a name isn't split
+                    cut = WORD_TAIL_RE.match(text, NAME_SEARCH_CHARS).end()
+                    rank, head_name = _find_name(text[:cut])
+                    if rank == 0:
+                        name_rank, name = rank, head_name
+                if name_rank == 0:
+                    if email is None:
+                        email = extract_email_from_text(text)
+                    rank = None
+                elif email is None:
+                    email, rank, page_name = extract_email_and_name(text)
+                else:
+                    rank, page_name = _find_name(text)
+                if rank is not None and (name_rank is None or rank < name_rank):
+                    name_rank, name = rank, page_name
+                if email and name_rank == 0:
+                    break
+    except Exception as e:
+        return {'error': str(e)}
+    finally:
+        # Parsed pages leave large reference cycles behind (page objects,
+        # fonts, layout); reclaim them right after long documents so worker
+        # memory doesn't creep up over a long batch
+        if pages_read > GC_PAGE_THRESHOLD:
+            gc.collect()
+    
+    if name is None:
+        name = extract_name_from_text('', email)
+    return {'email': email, 'name': name}
+
+
 def process_pdfs(pdf_folder, output_folder=None, csv_output="email_list.csv"):
     """
     Process all PDFs in folder:
     1. Extract name and email
     2. Rename PDF to format: email_name.pdf
     3. Create CSV mapping file
+    Returns the number of PDFs processed and the number that failed.
     """
     pdf_folder = Path(pdf_folder)
     output_folder = Path(output_folder) if output_folder else pdf_folder / "renamed"
     output_folder.mkdir(exist_ok=True)
     
-    results = []
-    errors = []
+    # Names are compared casefolded, since the output folder may be on a
+    # case-insensitive filesystem (macOS, Windows)
+    used_names = {}  # casefolded filename stem -> next duplicate suffix
+    # One directory listing up front instead of an exists() call per name
+    existing = {entry.casefold() for entry in os.listdir(output_folder)}
     
-    pdf_files = list(pdf_folder.glob("*.pdf"))
-    print(f"Found {len(pdf_files)} PDF files to process")
+    with os.scandir(pdf_folder) as entries:
+        pdf_files = [
+            Path(entry.path) for entry in entries
+            if entry.name.lower().endswith('.pdf') and entry.is_file()
+        ]
+    log.info(f"Found {len(pdf_files)} PDF files to process")
     
-    for i, pdf_path in enumerate(pdf_files, 1):
-        print(f"Processing {i}/{len(pdf_files)}: {pdf_path.name}")
+    csv_path = output_folder / csv_output
+    error_path = output_folder / "errors.csv"
+    processed = failed = 0
+    
+    # Rows are written as each PDF finishes, so a crash keeps the rows so
+    # far and memory use doesn't grow with the batch size
+    with ExitStack() as files:
+        results_writer = csv.DictWriter(
+            files.enter_context(open(csv_path, 'w', newline='', encoding='utf-8')),
+            fieldnames=['email', 'name', 'pdf_path', 'original_file', 'new_file']
+        )
+        results_writer.writeheader()
+        error_writer = None
         
-        try:
-            with pdfplumber.open(pdf_path) as pdf:
-                # Extract text from all pages
-                full_text = ""
-                for page in pdf.pages:
-                    text = page.extract_text()
-                    if text:
-                        full_text += text + "\n"
-            
-            # Extract email and name
-            email = extract_email_from_text(full_text)
-            name = extract_name_from_text(full_text, email)
-            
-            if not email:
-                errors.append({
-                    'file': pdf_path.name,
-                    'error': 'No Gmail found'
-                })
-                print(f"  ⚠ No Gmail found in {pdf_path.name}")
-                continue
-            
-            # Create new filename: email_name.pdf or just email.pdf
-            safe_name = re.sub(r'[^\w\s-]', '', name or '').replace(' ', '_') if name else ''
-            safe_email = email.replace('@gmail.com', '')
+        def record_error(file, error):
+            # errors.csv is only created once there is something to put in it
+            nonlocal error_writer, failed
+            if error_writer is None:
+                error_writer = csv.DictWriter(
+                    files.enter_context(open(error_path, 'w', newline='', encoding='utf-8')),
+                    fieldnames=['file', 'error']
+                )
+                error_writer.writeheader()
+            error_writer.writerow({'file': file, 'error': error})
+            failed += 1
+        
+        # Per-file results go to the debug log; a progress bar (if tqdm is
+        # installed) shows how far along the batch is instead
+        progress = None
+        if tqdm is not None:
+            files.enter_context(logging_redirect_tqdm())
+            progress = files.enter_context(tqdm(total=len(pdf_files), unit='pdf'))
+        
+        # Handed-off copies, reported in file order once each one is done
+        pending = deque()
+        
+        def finish_oldest():
+            # Report the oldest file, waiting for its copy if necessary
+            nonlocal processed
+            i, pdf_path, copy, row, error = pending.popleft()
+            log.debug(f"Processing {i}/{len(pdf_files)}: {pdf_path.name}")
+            if copy is not None:
+                try:
+                    copy.result()
+                except Exception as e:
+                    error = str(e)
             
-            if safe_name:
-                new_filename = f"{safe_email}_{safe_name}.pdf"
+            if error is None:
+                results_writer.writerow(row)
+                processed += 1
+                log.debug(f"  ✓ {row['email']} - {row['name'] or 'No name'}")
+            elif error == NO_GMAIL:
+                record_error(pdf_path.name, error)
+                log.warning(f"⚠ No Gmail found in {pdf_path.name}")
             else:
-                new_filename = f"{safe_email}.pdf"
-            
-            # Copy/rename to output folder
-            new_path = output_folder / new_filename
+                record_error(pdf_path.name, error)
+                log.warning(f"✗ Error in {pdf_path.name}: {error}")
+            if progress is not None:
+                progress.update()
+        
+        # Text extraction is CPU-bound, so parse PDFs in parallel across cores.
+        # Results come back in file order; naming stays serial so duplicate
+        # filenames are resolved the same way on every run. Copies are I/O
+        # and run on a few threads, overlapping with the parsing.
+        with ProcessPoolExecutor(max_workers=os.cpu_count()) as pool, \
+                ThreadPoolExecutor(max_workers=COPY_WORKERS) as copier:
+            extracted = pool.map(_process_one, pdf_files, chunksize=4)
             
-            # Handle duplicate filenames
-            counter = 1
-            while new_path.exists():
-                if safe_name:
-                    new_filename = f"{safe_email}_{safe_name}_{counter}.pdf"
+            for i, (pdf_path, info) in enumerate(zip(pdf_files, extracted), 1):
+                if 'error' in info:
+                    pending.append((i, pdf_path, None, None, info['error']))
+                elif not info['email']:
+                    pending.append((i, pdf_path, None, None, NO_GMAIL))
                 else:
-                    new_filename = f"{safe_email}_{counter}.pdf"
-                new_path = output_folder / new_filename
-                counter += 1
-            
-            # Copy file to new location with new name
-            import shutil
-            shutil.copy2(pdf_path, new_path)
-            
-            results.append({
-                'original_file': pdf_path.name,
-                'new_file': new_filename,
-                'email': email,
-                'name': name or '',
-                'pdf_path': str(new_path)
-            })
+                    email = info['email']
+                    name = info['name']
+                    try:
+                        # Create new filename: email_name.pdf or just email.pdf
+                        safe_name = _safe_name(name) if name else ''
+                        safe_email = email.replace('@gmail.com', '')
+                        
+                        stem = f"{safe_email}_{safe_name}" if safe_name else safe_email
+                        
+                        # Handle duplicate filenames: remember the next suffix for
+                        # each stem, and skip names already in the output folder
+                        stem_key = stem.casefold()
+                        counter = used_names.get(stem_key, 0)
+                        new_filename = f"{stem}_{counter}.pdf" if counter else f"{stem}.pdf"
+                        while new_filename.casefold() in existing:  # e.g. left over from an earlier run
+                            counter += 1
+                            new_filename = f"{stem}_{counter}.pdf"
+                        used_names[stem_key] = counter + 1
+                        existing.add(new_filename.casefold())
+                        new_path = output_folder / new_filename
+                        
+                        # Copy file to new location with new name
+                        copy = copier.submit(_fast_copy, pdf_path, new_path)
+                        pending.append((i, pdf_path, copy, {
+                            'original_file': pdf_path.name,
+                            'new_file': new_filename,
+                            'email': email,
+                            'name': name or '',
+                            'pdf_path': str(new_path)
+                        }, None))
+                    except Exception as e:
+                        pending.append((i, pdf_path, None, None, str(e)))
+                
+                # Report whatever has finished; block only when too many
+                # copies are queued up behind a slow one
+                while pending and (
+                    len(pending) > COPY_BACKLOG
+                    or pending[0][2] is None
+                    or pending[0][2].done()
+                ):
+                    finish_oldest()
             
-            print(f"  ✓ {email} - {name or 'No name'}")
-            
-        except Exception as e:
-            errors.append({
-                'file': pdf_path.name,
-                'error': str(e)
-            })
-            print(f"  ✗ Error: {e}")
-    
-    # Save results to CSV
-    csv_path = output_folder / csv_output
-    with open(csv_path, 'w', newline='', encoding='utf-8') as f:
-        writer = csv.DictWriter(f, fieldnames=['email', 'name', 'pdf_path', 'original_file', 'new_file'])
-        writer.writeheader()
-        writer.writerows(results)
-    
-    # Save errors to separate file
-    if errors:
-        error_path = output_folder / "errors.csv"
-        with open(error_path, 'w', newline='', encoding='utf-8') as f:
-            writer = csv.DictWriter(f, fieldnames=['file', 'error'])
-            writer.writeheader()
-            writer.writerows(errors)
+            while pending:
+                finish_oldest()
     
-    print(f"\n{'='*50}")
-    print(f"Successfully processed: {len(results)} files")
-    print(f"Errors: {len(errors)} files")
-    print(f"CSV saved to: {csv_path}")
-    if errors:
-        print(f"Errors saved to: {output_folder / 'errors.csv'}")
+    log.info(f"\n{'='*50}")
+    log.info(f"Successfully processed: {processed} files")
+    log.info(f"Errors: {failed} files")
+    log.info(f"CSV saved to: {csv_path}")
+    if failed:
+        log.info(f"Errors saved to: {error_path}")
     
-    return results, errors
+    return processed, failed
 
 
 if __name__ == "__main__":
@@ -161,4 +526,6 @@ if __name__ == "__main__":
     PDF_FOLDER = "./pdfs"  # Folder containing your PDFs
     OUTPUT_FOLDER = "./renamed_pdfs"  # Where renamed PDFs will go
     
-    results, errors = process_pdfs(PDF_FOLDER, OUTPUT_FOLDER)
+    # Use level=logging.DEBUG to see a line for every PDF
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+    processed, failed = process_pdfs(PDF_FOLDER, OUTPUT_FOLDER)
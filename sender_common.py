@@ -0,0 +1,606 @@
+"""
+Code shared by bulk_email_sender.py and bulk_email_sender_smtp.py.
+Standard library only (pandas is used when installed), so the SMTP sender
+keeps needing no extra packages.
+"""
+
+import os
+import csv
+import atexit
+import signal
+import pickle
+import random
+import mmap
+import base64
+import functools
+import threading
+from pathlib import Path
+from collections import namedtuple
+from email.mime.text import MIMEText
+from email.mime.multipart import MIMEMultipart
+from email.mime.base import MIMEBase
+from datetime import datetime
+
+try:
+    import sqlite3
+except ImportError:  # some minimal Python builds ship without it
+    sqlite3 = None
+
+try:
+    import pandas as pd
+except ImportError:  # optional: only used to speed up loading large email lists
+    pd = None
+
+
+# Re-save the cached set of sent addresses after this many log rows
+SENT_CACHE_EVERY = 50
+
+# One pending email from the email list CSV
+EmailRow = namedtuple('EmailRow', ['email', 'name', 'pdf_path'])
+
+# Stand-ins for per-recipient values in cached message skeletons
+_SENDER_TOKEN = '__SENDER__'
+_RCPT_TOKEN = '__RCPT__'
+_NAME_TOKEN = '__NAME__'
+
+
+class BaseAccountManager:
+    """
+    Daily send quotas and adaptive pacing for a set of sender accounts.
+    Subclasses fill self.accounts (name -> account details) as they set
+    accounts up.
+    """
+
+    def __init__(self, progress_file, daily_limit):
+        """
+        Args:
+            progress_file: Pickle file for send counts; the SQLite DB and the
+                WAL live next to it
+            daily_limit: Max sends per account per day
+        """
+        self.daily_limit = daily_limit
+        self.accounts = {}
+        self.send_counts = {}
+        self.progress_file = progress_file
+        self.wal_file = self.progress_file.with_suffix('.wal')
+        self._wal = None            # append-only log of sends since the last save (pickle fallback)
+        self.progress_db = self.progress_file.with_suffix('.db')
+        self._db_lock = threading.Lock()
+        self._db = self._open_progress_db() if sqlite3 is not None else None
+        self.load_progress()
+
+    # ---- progress tracking ----
+
+    def _open_progress_db(self):
+        """
+        Open the SQLite progress store in WAL mode, so several sender
+        processes on this machine can record sends at once. (WAL does not
+        work across hosts sharing the folder over a network filesystem.)
+        """
+        self.progress_db.parent.mkdir(parents=True, exist_ok=True)
+        db = sqlite3.connect(self.progress_db, isolation_level=None, check_same_thread=False, timeout=30)
+        db.execute("PRAGMA journal_mode=WAL")
+        db.execute("PRAGMA synchronous=NORMAL")
+        db.execute(
+            "CREATE TABLE IF NOT EXISTS sends("
+            "account TEXT, day DATE, count INT, PRIMARY KEY(account, day))"
+        )
+        return db
+
+    def _refresh_counts(self):
+        """Reload today's counts from the progress DB, including other processes' sends."""
+        if self._db is None:
+            return
+        with self._db_lock:
+            rows = self._db.execute(
+                "SELECT account, count FROM sends WHERE day = DATE('now', 'localtime')"
+            ).fetchall()
+        self.send_counts = {**{name: 0 for name in self.accounts}, **dict(rows)}
+
+    def load_progress(self):
+        """
+        Load today's send counts from the progress DB. Without sqlite3, load
+        the progress pickle and replay today's sends from the WAL instead.
+        """
+        if self._db is not None:
+            self._refresh_counts()
+            return
+
+        today = datetime.now().date()
+        try:
+            with open(self.progress_file, 'rb') as f:
+                data = pickle.load(f)
+                # Reset counts if it's a new day
+                if data.get('date') == today:
+                    self.send_counts = data.get('counts', {})
+                else:
+                    self.send_counts = {}
+        except FileNotFoundError:
+            pass
+
+        try:
+            with open(self.wal_file, encoding='utf-8') as f:
+                for line in f:
+                    day, _, name = line.rstrip('\n').partition(' ')
+                    if line.endswith('\n') and name and day == today.isoformat():
+                        # "-name" lines undo a reservation whose send failed
+                        delta = -1 if name.startswith('-') else 1
+                        name = name.lstrip('-')
+                        self.send_counts[name] = self.send_counts.get(name, 0) + delta
+        except FileNotFoundError:
+            pass
+
+    def save_progress(self):
+        """Save sending progress to file and drop the WAL it now covers (pickle fallback only)."""
+        if self._db is not None:
+            return  # every send is already committed to the DB
+
+        with open(self.progress_file, 'wb') as f:
+            pickle.dump({
+                'date': datetime.now().date(),
+                'counts': self.send_counts
+            }, f)
+
+        if self._wal is not None:
+            self._wal.close()
+            self._wal = None
+        self.wal_file.unlink(missing_ok=True)
+
+    def _append_wal(self, line, count):
+        """Append count copies of a WAL line instead of rewriting the whole progress file."""
+        if self._wal is None:
+            self._wal = open(self.wal_file, 'a', buffering=1, encoding='utf-8')
+        self._wal.write(f"{datetime.now().date().isoformat()} {line}\n" * count)
+
+    def reserve_sends(self, account_name, count=1):
+        """
+        Claim up to `count` sends from an account's daily quota before sending.
+        With the progress DB the read and the increment happen in one write
+        transaction, so sender processes sharing the DB can't go over the
+        limit together. Returns how many sends were claimed.
+        """
+        if self._db is None:
+            used = self.send_counts.get(account_name, 0)
+            reserved = max(min(count, self.daily_limit - used), 0)
+            if reserved:
+                self._append_wal(account_name, reserved)
+        else:
+            with self._db_lock:
+                self._db.execute("BEGIN IMMEDIATE")
+                try:
+                    row = self._db.execute(
+                        "SELECT count FROM sends WHERE account = ? AND day = DATE('now', 'localtime')",
+                        (account_name,)
+                    ).fetchone()
+                    used = row[0] if row else 0
+                    reserved = max(min(count, self.daily_limit - used), 0)
+                    self._db.execute(
+                        "INSERT INTO sends(account, day, count) VALUES(?, DATE('now', 'localtime'), ?) "
+                        "ON CONFLICT(account, day) DO UPDATE SET count = count + excluded.count",
+                        (account_name, reserved)
+                    )
+                    self._db.execute("COMMIT")
+                except BaseException:
+                    self._db.execute("ROLLBACK")
+                    raise
+        self.send_counts[account_name] = used + reserved
+        return reserved
+
+    def release_sends(self, account_name, count=1):
+        """Give back sends claimed with reserve_sends() that did not go out."""
+        self.send_counts[account_name] = max(self.send_counts.get(account_name, 0) - count, 0)
+
+        if self._db is None:
+            self._append_wal(f"-{account_name}", count)
+            return
+
+        with self._db_lock:
+            self._db.execute(
+                "UPDATE sends SET count = MAX(count - ?, 0) "
+                "WHERE account = ? AND day = DATE('now', 'localtime')",
+                (count, account_name)
+            )
+
+    def get_total_capacity(self):
+        """Get total remaining capacity across all accounts."""
+        self._refresh_counts()
+        return sum(self.daily_limit - count for count in self.send_counts.values())
+
+    # ---- adaptive pacing ----
+
+    def reset_pacing(self, min_delay, max_delay):
+        """
+        Start every account at the minimum delay between sends. Delays are
+        adjusted per account by record_result (AIMD): shrink slowly while
+        sends succeed, double whenever Gmail pushes back.
+        """
+        self.min_delay_ms = min_delay * 1000
+        self.pause_delay_ms = max_delay * 1000
+        self.max_delay_ms = 5 * max_delay * 1000
+        self.delay_ms = {name: self.min_delay_ms for name in self.accounts}
+        self.consec_ok = {name: 0 for name in self.accounts}
+
+    def record_result(self, account_name, throttled):
+        """Update an account's delay after a send (or batch) that was throttled or succeeded."""
+        if throttled:
+            self.delay_ms[account_name] = min(self.delay_ms[account_name] * 2, self.max_delay_ms)
+            self.consec_ok[account_name] = 0
+            return
+
+        self.consec_ok[account_name] += 1
+        if self.consec_ok[account_name] >= 20:
+            self.delay_ms[account_name] = max(self.delay_ms[account_name] * 0.95, self.min_delay_ms)
+
+    def next_delay(self, account_name):
+        """Seconds to wait before the account's next send, with +/-20% jitter."""
+        return self.delay_ms[account_name] / 1000 * random.uniform(0.8, 1.2)
+
+    def needs_pause(self, account_name):
+        """Whether the account has backed off all the way and should rest."""
+        return self.delay_ms[account_name] >= self.max_delay_ms
+
+    def end_pause(self, account_name):
+        """Resume an account after a rest, at the old maximum delay."""
+        self.delay_ms[account_name] = self.pause_delay_ms
+        self.consec_ok[account_name] = 0
+
+
+def prefetch_attachments(paths):
+    """
+    Ask the kernel to start reading the given attachments into the page
+    cache, so disk reads overlap with sending instead of stalling it.
+    Callers pass only what is about to be sent, so the pages are still
+    cached when they are needed.
+    No-op where posix_fadvise is unavailable (Windows, macOS).
+    """
+    if not hasattr(os, 'posix_fadvise'):
+        return
+    for path in set(paths):
+        try:
+            fd = os.open(path, os.O_RDONLY)
+        except OSError:
+            continue
+        try:
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_WILLNEED)
+        except OSError:
+            pass
+        finally:
+            os.close(fd)
+
+
+def _encode_attachment(attachment_path):
+    """
+    Base64-encode a file for a MIME part, reading it through mmap so the
+    encoder works straight from the page cache instead of a copy in memory.
+    """
+    with open(attachment_path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return ''
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            return base64.encodebytes(mm).decode('ascii')
+
+
+def build_mime_message(sender, to, subject, body, attachment_path):
+    """Build the MIME message with attachment."""
+    message = MIMEMultipart()
+    message['To'] = to
+    message['From'] = sender
+    message['Subject'] = subject
+
+    message.attach(MIMEText(body, 'plain'))
+
+    attachment_path = Path(attachment_path)
+    try:
+        payload = _encode_attachment(attachment_path)
+    except FileNotFoundError:
+        raise FileNotFoundError(f"Attachment not found: {attachment_path}") from None
+
+    part = MIMEBase('application', 'octet-stream')
+    part.set_payload(payload)
+    part['Content-Transfer-Encoding'] = 'base64'
+    part.add_header(
+        'Content-Disposition',
+        f'attachment; filename="{attachment_path.name}"'
+    )
+    message.attach(part)
+
+    return message
+
+
+@functools.lru_cache(maxsize=16)
+def _template_parts(template):
+    """Split a template on {name} once, so filling it is a single join."""
+    return tuple(template.split('{name}'))
+
+
+def fill_template(template, name):
+    """Replace every {name} placeholder in a template."""
+    return name.join(_template_parts(template))
+
+
+# Each entry holds a whole encoded message, so keep only a few
+@functools.lru_cache(maxsize=4)
+def _build_skeleton(attachment_path, subject_template, body_template):
+    """
+    Build and encode a message once per attachment/template, with tokens
+    standing in for the sender, recipient and {name}.
+    """
+    message = build_mime_message(
+        _SENDER_TOKEN, _RCPT_TOKEN,
+        fill_template(subject_template, _NAME_TOKEN),
+        fill_template(body_template, _NAME_TOKEN),
+        attachment_path
+    )
+    return message.as_bytes()
+
+
+def _can_use_skeleton(sender, to, name, subject_template, body_template):
+    """
+    Tokens can only be swapped in bytes when nothing needs MIME encoding
+    (plain ASCII, no line breaks in header values) and the templates do
+    not already contain a token.
+    """
+    for value in (sender, to, name):
+        if not (value.isascii() and value.isprintable()):
+            return False
+    for template in (subject_template, body_template):
+        if not template.isascii():
+            return False
+        if any(token in template for token in (_SENDER_TOKEN, _RCPT_TOKEN, _NAME_TOKEN)):
+            return False
+    return True
+
+
+def build_personalized_message(sender, to, name, subject_template, body_template, attachment_path,
+                               shared=False):
+    """
+    Create the bytes of a personalized email with attachment, filling {name}
+    in the subject and body. When the attachment is shared by several
+    recipients it is only read and encoded once per attachment/template; each
+    recipient just swaps their details into it. One-off attachments are built
+    directly.
+    """
+    if not shared or not _can_use_skeleton(sender, to, name, subject_template, body_template):
+        message = build_mime_message(
+            sender, to,
+            fill_template(subject_template, name),
+            fill_template(body_template, name),
+            attachment_path
+        )
+        return message.as_bytes()
+
+    skeleton = _build_skeleton(str(attachment_path), subject_template, body_template)
+    return (
+        skeleton
+        .replace(_SENDER_TOKEN.encode(), sender.encode())
+        .replace(_RCPT_TOKEN.encode(), to.encode())
+        .replace(_NAME_TOKEN.encode(), name.encode())
+    )
+
+
+def _sent_cache_path(log_path):
+    """Path of the pickled set of sent addresses kept next to the send log."""
+    return log_path.with_suffix('.sent.pkl')
+
+
+def save_sent_emails(log_path, sent_emails, log_offset):
+    """
+    Cache the sent addresses so the next run can skip scanning the log.
+    The set must cover every row in the first log_offset bytes of the log.
+    """
+    cache_path = _sent_cache_path(log_path)
+    tmp_path = cache_path.with_suffix(f'.{os.getpid()}.tmp')
+    with open(tmp_path, 'wb') as f:
+        pickle.dump((log_offset, sent_emails), f)
+    os.replace(tmp_path, cache_path)
+
+
+def read_sent_rows(log_path, sent_emails, start=0):
+    """
+    Add the addresses the send log marks as sent to sent_emails, streaming
+    the log from byte offset start. Returns the offset just past the last
+    complete row, where the next read should pick up.
+    """
+    try:
+        f = open(log_path, 'rb')
+    except FileNotFoundError:
+        return 0
+    with f:
+        header = next(csv.reader([f.readline().decode('utf-8')]), None)
+        if header is None:  # empty log, e.g. crashed before the first flush
+            return 0
+        email_i = header.index('email')
+        status_i = header.index('status')
+        end = max(start, f.tell())
+        f.seek(end)
+        consumed = end
+
+        def lines():
+            nonlocal consumed
+            for line in f:
+                if not line.endswith(b'\n'):
+                    return  # another process is part way through writing this row
+                consumed += len(line)
+                yield line.decode('utf-8')
+
+        try:
+            for row in csv.reader(lines()):
+                end = consumed
+                if len(row) > status_i and row[status_i] == 'sent':
+                    sent_emails.add(row[email_i])
+        except csv.Error:  # a quoted row cut off by a concurrent write
+            pass
+    return end
+
+
+def load_sent_emails(log_path):
+    """
+    Get the set of addresses the send log marks as sent, and the log offset
+    it covers. Starts from the cached set and only streams the log rows
+    written after it was saved, by this or any other sender process.
+    """
+    try:
+        with open(_sent_cache_path(log_path), 'rb') as f:
+            offset, sent_emails = pickle.load(f)
+        if log_path.stat().st_size < offset:  # the log was replaced
+            raise ValueError
+    except (OSError, EOFError, ValueError, TypeError, pickle.UnpicklingError):
+        offset, sent_emails = 0, set()
+    return sent_emails, read_sent_rows(log_path, sent_emails, offset)
+
+
+def load_pending_emails(email_list_csv, sent_emails):
+    """
+    Read the email list CSV (columns: email, name, pdf_path) into EmailRow
+    tuples, skipping addresses in sent_emails. The name column is optional;
+    rows without an email or pdf_path are skipped with a warning.
+    Uses pandas' C parser when it is installed, which is much faster for
+    large lists and stores each distinct pdf_path only once.
+    """
+    if pd is not None:
+        try:
+            df = pd.read_csv(
+                email_list_csv,
+                dtype={'email': str, 'name': str, 'pdf_path': 'category'},
+                keep_default_na=False,
+                encoding='utf-8',
+            )
+        except pd.errors.EmptyDataError:  # empty file
+            return []
+        if 'name' not in df.columns:
+            df['name'] = ''
+        # Fields missing from short rows come back as NaN
+        df['name'] = df['name'].fillna('')
+        complete = (df['email'].fillna('') != '') & df['pdf_path'].notna() & (df['pdf_path'] != '')
+        _warn_incomplete(email_list_csv, int((~complete).sum()))
+        df = df[complete & ~df['email'].isin(sent_emails)]
+        return [
+            EmailRow._make(row)
+            for row in df[['email', 'name', 'pdf_path']].itertuples(index=False, name=None)
+        ]
+
+    with open(email_list_csv, 'r', encoding='utf-8') as f:
+        reader = csv.reader(f)
+        header = next(reader, None)
+        if header is None:  # empty file
+            return []
+        email_i = header.index('email')
+        pdf_i = header.index('pdf_path')
+        name_i = header.index('name') if 'name' in header else None
+        min_len = max(email_i, pdf_i) + 1
+        pending = []
+        incomplete = 0
+        for row in reader:
+            if not row:
+                continue
+            if len(row) < min_len or not row[email_i] or not row[pdf_i]:
+                incomplete += 1
+                continue
+            if row[email_i] in sent_emails:
+                continue
+            name = row[name_i] if name_i is not None and name_i < len(row) else ''
+            pending.append(EmailRow(row[email_i], name, row[pdf_i]))
+    _warn_incomplete(email_list_csv, incomplete)
+    return pending
+
+
+def _warn_incomplete(email_list_csv, count):
+    """Report email list rows skipped for lacking an email or pdf_path."""
+    if count:
+        print(f"⚠ Skipped {count} row(s) in {email_list_csv} without an email or pdf_path")
+
+
+def _open_or_create(path):
+    """
+    Open a CSV file for appending, creating it if needed. Also reports
+    whether it already had content, from the append position rather than
+    a separate stat() call.
+    """
+    f = open(path, 'a', newline='', encoding='utf-8')
+    return f, f.tell() > 0
+
+
+class SendLog:
+    """
+    The CSV send log, which doubles as the resume record. Rows are buffered
+    and written out by flush(); the set of addresses marked sent is cached
+    next to the log every SENT_CACHE_EVERY rows and on close(). Use it as a
+    context manager around the send loop.
+    """
+
+    def __init__(self, log_file, header):
+        """
+        Args:
+            log_file: CSV file to append sent/failed rows to
+            header: Column names, written when the log is new; must include
+                'email' and 'status'
+        """
+        self.path = Path(log_file)
+        self.header = header
+        self.sent_emails, self._sent_offset = load_sent_emails(self.path)
+        self._email_i = header.index('email')
+        self._status_i = header.index('status')
+        self._file = None
+        self._writer = None
+        self._buffer = []
+        self._unsaved_rows = 0
+        self._previous_sigterm = None
+
+    def open(self):
+        """Open the log for appending, writing the header if it is new."""
+        self._file, has_rows = _open_or_create(self.path)
+        self._writer = csv.writer(self._file)
+        if not has_rows:
+            self._writer.writerow(self.header)
+
+    def add(self, row):
+        """Buffer one log row, remembering its address if it was sent."""
+        self._buffer.append(row)
+        if row[self._status_i] == 'sent':
+            self.sent_emails.add(row[self._email_i])
+
+    def flush(self):
+        """Write buffered rows to the send log; re-cache the sent set every SENT_CACHE_EVERY rows."""
+        if not self._buffer:
+            return
+        self._writer.writerows(self._buffer)
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._unsaved_rows += len(self._buffer)
+        self._buffer.clear()
+        if self._unsaved_rows >= SENT_CACHE_EVERY:
+            self.save_sent_cache()
+
+    def save_sent_cache(self):
+        """Bring the sent set up to date with the log (other processes' rows too) and cache it."""
+        self._sent_offset = read_sent_rows(self.path, self.sent_emails, self._sent_offset)
+        save_sent_emails(self.path, self.sent_emails, self._sent_offset)
+        self._unsaved_rows = 0
+
+    def close(self):
+        """Write out any buffered rows, cache the sent set and close the log."""
+        self.flush()
+        self.save_sent_cache()
+        self._file.close()
+
+    def __enter__(self):
+        """
+        Open the log. Until __exit__, buffered rows are also flushed at
+        interpreter exit, and SIGTERM is turned into KeyboardInterrupt so a
+        killed run unwinds (and logs) the same way as Ctrl-C.
+        """
+        self.open()
+        atexit.register(self.flush)
+        if threading.current_thread() is threading.main_thread():
+            self._previous_sigterm = signal.signal(signal.SIGTERM, signal.default_int_handler)
+        return self
+
+    def __exit__(self, *exc_info):
+        """Close the log and put back the exit hook and SIGTERM handler, however the loop ended."""
+        try:
+            self.close()
+        finally:
+            atexit.unregister(self.flush)
+            if self._previous_sigterm is not None:
+                signal.signal(signal.SIGTERM, self._previous_sigterm)
+                self._previous_sigterm = None